@@ -4,7 +4,8 @@
 Simple tests of the Python MuPDF API.
 '''
 
-import inspect
+import array
+import concurrent.futures
 import os
 import platform
 import sys
@@ -24,10 +25,16 @@ else:
 
 _log_prefix = ''
 
+# Logging can be disabled by setting MUPDF_test_log=0.
+_log_enabled = os.environ.get('MUPDF_test_log') != '0'
+
 def log(text):
-    f = inspect.stack()[1]
-    print(f'{f.filename}:{f.lineno} {_log_prefix}{text}', file=sys.stderr)
-    sys.stderr.flush()
+    if not _log_enabled:
+        return
+    # sys._getframe() is much faster than inspect.stack(), which creates
+    # information about all frames.
+    f = sys._getframe(1)
+    sys.stderr.write(f'{f.f_code.co_filename}:{f.f_lineno} {_log_prefix}{text}\n')
 
 def log_prefix_set(prefix):
     global _log_prefix
@@ -37,11 +44,20 @@ g_test_n = 0
 
 g_mupdf_root = os.path.abspath('%s/../..' % __file__)
 
+# Objects that are used repeatedly by test().
+g_colorspace_rgb = mupdf.FzColorspace(mupdf.FzColorspace.Fixed_RGB)
+g_matrix_identity = mupdf.FzMatrix(mupdf.fz_identity)
+
 
 def show_stext(document):
     '''
     Shows all available information about Stext blocks, lines and characters.
+
+    Does nothing if logging is disabled, because the output is all that this
+    function produces.
     '''
+    if not _log_enabled:
+        return
     for p in range(document.count_pages()):
         page = document.load_page(p)
         stextpage = mupdf.StextPage(page, mupdf.StextOptions())
@@ -51,27 +67,29 @@ def show_stext(document):
             for line in block:
                 line_ = line.m_internal
                 log(f'    line: wmode={line_.wmode}'
-                        + f' dir={line_.dir}'
-                        + f' bbox={line_.bbox}'
+                        f' dir={line_.dir}'
+                        f' bbox={line_.bbox}'
                         )
                 for char in line:
                     char_ = char.m_internal
-                    log(f'        char: {chr(char_.c)!r} c={char_.c:4} color={char_.color}'
-                            + f' origin={char_.origin}'
-                            + f' quad={char_.quad}'
-                            + f' size={char_.size:6.2f}'
-                            + f' font=('
-                                +  f'is_mono={char_.font.flags.is_mono}'
-                                + f' is_bold={char_.font.flags.is_bold}'
-                                + f' is_italic={char_.font.flags.is_italic}'
-                                + f' ft_substitute={char_.font.flags.ft_substitute}'
-                                + f' ft_stretch={char_.font.flags.ft_stretch}'
-                                + f' fake_bold={char_.font.flags.fake_bold}'
-                                + f' fake_italic={char_.font.flags.fake_italic}'
-                                + f' has_opentype={char_.font.flags.has_opentype}'
-                                + f' invalid_bbox={char_.font.flags.invalid_bbox}'
-                                + f' name={char_.font.name}'
-                                + f')'
+                    c = char_.c
+                    flags = char_.font.flags
+                    log(f'        char: {chr(c)!r} c={c:4} color={char_.color}'
+                            f' origin={char_.origin}'
+                            f' quad={char_.quad}'
+                            f' size={char_.size:6.2f}'
+                            f' font=('
+                                f'is_mono={flags.is_mono}'
+                                f' is_bold={flags.is_bold}'
+                                f' is_italic={flags.is_italic}'
+                                f' ft_substitute={flags.ft_substitute}'
+                                f' ft_stretch={flags.ft_stretch}'
+                                f' fake_bold={flags.fake_bold}'
+                                f' fake_italic={flags.fake_italic}'
+                                f' has_opentype={flags.has_opentype}'
+                                f' invalid_bbox={flags.invalid_bbox}'
+                                f' name={char_.font.name}'
+                                f')'
                             )
 
 
@@ -143,7 +161,7 @@ def test_filter(path):
             document.pdf_end_operation()
 
     if 1:
-        document.pdf_save_document('mupdf_test-out0.pdf', mupdf.PdfWriteOptions())
+        document.pdf_save_document(f'mupdf_test-out0-{g_test_n}.pdf', mupdf.PdfWriteOptions())
 
 
 def test(path):
@@ -171,9 +189,13 @@ def test(path):
 
     # Test operations using functions:
     #
+    # We open the document only once and use it for both functions and
+    # classes, because opening a document is relatively expensive.
+    #
     log('Testing functions.')
     log(f'    Opening: %s' % path)
-    document = mupdf.fz_open_document(path)
+    document = mupdf.FzDocument(path)
+    log(f'Have created mupdf.FzDocument for {path}')
     log(f'    mupdf.fz_needs_password(document)={mupdf.fz_needs_password(document)}')
     log(f'    mupdf.fz_count_pages(document)={mupdf.fz_count_pages(document)}')
     log(f'    mupdf.fz_document_output_intent(document)={mupdf.fz_document_output_intent(document)}')
@@ -182,8 +204,6 @@ def test(path):
     #
     log(f'Testing classes')
 
-    document = mupdf.FzDocument(path)
-    log(f'Have created mupdf.FzDocument for {path}')
     log(f'document.fz_needs_password()={document.fz_needs_password()}')
     log(f'document.fz_count_pages()={document.fz_count_pages()}')
 
@@ -191,7 +211,7 @@ def test(path):
         log(f'stext info:')
         show_stext(document)
 
-    for k in (
+    metadata_keys = (
             'format',
             'encryption',
             'info:Author',
@@ -199,8 +219,14 @@ def test(path):
             'info:Creator',
             'info:Producer',
             'qwerty',
-            ):
-        v = document.fz_lookup_metadata(k)
+            )
+    if hasattr(mupdf, 'fz_lookup_metadata_many'):
+        # swig
+        metadata = document.fz_lookup_metadata_many(metadata_keys)
+    else:
+        # cppyy
+        metadata = {k: document.fz_lookup_metadata(k) for k in metadata_keys}
+    for k, v in metadata.items():
         log(f'document.fz_lookup_metadata() k={k} returned v={v!r}')
         if k == 'qwerty':
             assert v is None, f'v={v!r}'
@@ -212,7 +238,7 @@ def test(path):
     page_number = 0
     log(f'Have created scale: a={scale.a} b={scale.b} c={scale.c} d={scale.d} e={scale.e} f={scale.f}')
 
-    colorspace = mupdf.FzColorspace(mupdf.FzColorspace.Fixed_RGB)
+    colorspace = g_colorspace_rgb
     log(f'colorspace.m_internal.key_storable.storable.refs={colorspace.m_internal.key_storable.storable.refs!r}')
     if 0:
         c = colorspace.fz_clamp_color([3.14])
@@ -220,62 +246,96 @@ def test(path):
     pixmap = mupdf.FzPixmap(document, page_number, scale, colorspace, 0)
     log(f'Have created pixmap: {pixmap.m_internal.w} {pixmap.m_internal.h} {pixmap.m_internal.stride} {pixmap.m_internal.n}')
 
-    filename = f'mupdf_test-out1-{g_test_n}.png'
-    pixmap.fz_save_pixmap_as_png(filename)
-    log(f'Have created {filename} using pixmap.save_pixmap_as_png().')
-
-    # Print image data in ascii PPM format. Copied from
-    # mupdf/docs/examples/example.c.
+    # Write the pixmap as .png and as binary PPM. Based on
+    # mupdf/docs/examples/example.c, but writing raw bytes instead of ascii.
+    #
+    # With SWIG, fz_save_pixmap_as_png_and_pnm() writes both files from one
+    # pass over the samples; we then read the .ppm back and check it against
+    # a `memoryview` of the pixmap's samples, which is an extra pass done only
+    # for testing. Otherwise we save the .png and then write the .ppm from a
+    # copy of the samples, with a single write() if rows are not padded,
+    # otherwise one row at a time.
     #
-    samples = pixmap.samples()
     stride = pixmap.stride()
     n = pixmap.n()
+    w = pixmap.m_internal.w
+    h = pixmap.m_internal.h
+    assert n == 3, f'n={n}'
+    row_size = w * n
+    ppm_header = b'P6\n%d %d\n255\n' % (w, h)
+    png_filename = f'mupdf_test-out1-{g_test_n}.png'
     filename = f'mupdf_test-out2-{g_test_n}.ppm'
-    with open(filename, 'w') as f:
-        f.write('P3\n')
-        f.write('%s %s\n' % (pixmap.m_internal.w, pixmap.m_internal.h))
-        f.write('255\n')
-        for y in range(0, pixmap.m_internal.h):
-            for x in range(pixmap.m_internal.w):
-                if x:
-                    f.write('  ')
-                offset = y * stride + x * n
-                if hasattr(mupdf, 'bytes_getitem'):
-                    # swig
-                    f.write('%3d %3d %3d' % (
-                            mupdf.bytes_getitem(samples, offset + 0),
-                            mupdf.bytes_getitem(samples, offset + 1),
-                            mupdf.bytes_getitem(samples, offset + 2),
-                            ))
-                else:
-                    # cppyy
-                    f.write('%3d %3d %3d' % (
-                            samples[offset + 0],
-                            samples[offset + 1],
-                            samples[offset + 2],
-                            ))
-            f.write('\n')
-    log(f'Have created {filename} by scanning pixmap.')
+    if hasattr(mupdf, 'fz_save_pixmap_as_png_and_pnm'):
+        # swig
+        pixmap.fz_save_pixmap_as_png_and_pnm(png_filename, filename)
+        samples_bytes = pixmap.fz_pixmap_samples2()
+        with open(filename, 'rb') as f:
+            ppm = f.read()
+        assert ppm[:len(ppm_header)] == ppm_header
+        ppm = memoryview(ppm)[len(ppm_header):]
+        assert len(ppm) == row_size * h, f'len(ppm)={len(ppm)} row_size={row_size} h={h}'
+        for y in range(h):
+            assert ppm[y * row_size : (y+1) * row_size] == samples_bytes[y * stride : y * stride + row_size]
+        log(f'Have created {png_filename} and {filename} using pixmap.fz_save_pixmap_as_png_and_pnm().')
+    else:
+        # cppyy
+        pixmap.fz_save_pixmap_as_png(png_filename)
+        log(f'Have created {png_filename} using pixmap.save_pixmap_as_png().')
+        samples_bytes = mupdf.raw_to_python_bytes(pixmap.samples(), stride * h)
+        with open(filename, 'wb') as f:
+            write = f.write
+            write(ppm_header)
+            if stride == row_size:
+                write(samples_bytes)
+            else:
+                for offset in range(0, h * stride, stride):
+                    write(samples_bytes[offset : offset + row_size])
+        log(f'Have created {filename} by scanning pixmap.')
 
     # Generate .png and but create Pixmap from Page instead of from Document.
     #
+    # We reuse `page` below instead of reloading page 0 each time, because
+    # loading a page is relatively expensive.
+    #
     page = mupdf.FzPage(document, 0)
     separations = page.fz_page_separations()
     log(f'page_separations() returned {"true" if separations else "false"}')
     pixmap = mupdf.FzPixmap(page, scale, colorspace, 0)
     filename = f'mupdf_test-out3-{g_test_n}.png'
-    pixmap.fz_save_pixmap_as_png(filename)
-    log(f'Have created {filename} using pixmap.fz_save_pixmap_as_png()')
+    if hasattr(mupdf, 'fz_save_pixmap_as_png_nogil'):
+        # swig. fz_save_pixmap_as_png_nogil() releases the GIL, so we save the
+        # .png in a separate thread while checking search and links below.
+        save_executor = concurrent.futures.ThreadPoolExecutor(1)
+        save_future = save_executor.submit(pixmap.fz_save_pixmap_as_png_nogil, filename)
+    else:
+        # cppyy
+        save_future = None
+        pixmap.fz_save_pixmap_as_png(filename)
+        log(f'Have created {filename} using pixmap.fz_save_pixmap_as_png()')
+
+    # Check text search, getting all quads in a single bytes.
+    #
+    if hasattr(mupdf, 'fz_search_page_quads'):
+        # swig
+        quads = array.array('f', page.fz_search_page_quads('compression', 20))
+        assert len(quads) % 8 == 0
+        log(f'fz_search_page_quads() found {len(quads) // 8} quads')
+        for i in range(0, len(quads), 8):
+            log(f'    {list(quads[i : i+8])}')
 
     # Show links
     log(f'Links.')
-    page = mupdf.FzPage(document, 0)
     link = mupdf.fz_load_links(page);
     log(f'{link}')
     if link:
         for i in link:
             log(f'{i}')
 
+    if save_future:
+        save_future.result()
+        save_executor.shutdown()
+        log(f'Have created {filename} using pixmap.fz_save_pixmap_as_png_nogil() in a separate thread')
+
     # Check we can iterate over Link's, by creating one manually.
     #
     link = mupdf.FzLink(mupdf.FzRect(0, 0, 1, 1), "hello")
@@ -285,48 +345,65 @@ def test(path):
 
     # Check iteration over Outlines. We do depth-first iteration.
     #
+    # With SWIG we use fz_outline_visit(), which does the iteration in C++ and
+    # calls a Python callback for each item. We also check that
+    # fz_outline_iterator_walk() returns the same items.
+    #
     log(f'Outlines.')
-    def olog(text):
-        if 0:
-            log(text)
-    num_outline_items = 0
-    depth = 0
-    it = mupdf.FzOutlineIterator(document)
-    while 1:
-        item = it.fz_outline_iterator_item()
-        olog(f'depth={depth} valid={item.valid()}')
-        if item.valid():
-            log(f'{" "*depth*4}uri={item.uri()} is_open={item.is_open()} title={item.title()}')
-            num_outline_items += 1
-        else:
-            olog(f'{" "*depth*4}<null>')
-        r = it.fz_outline_iterator_down()
-        olog(f'depth={depth} down => {r}')
-        if r >= 0:
-            depth += 1
-        if r < 0:
-            r = it.fz_outline_iterator_next()
-            olog(f'depth={depth} next => {r}')
-            assert r
-            if r:
-                # No more items at current depth, so repeatedly go up until we
-                # can go right.
-                end = 0
-                while 1:
-                    r = it.fz_outline_iterator_up()
-                    olog(f'depth={depth} up => {r}')
-                    if r < 0:
-                        # We are at EOF. Need to break out of top-level loop.
-                        end = 1
-                        break
-                    depth -= 1
-                    r = it.fz_outline_iterator_next()
-                    olog(f'depth={depth} next => {r}')
-                    if r == 0:
-                        # There are items at this level.
+    if hasattr(mupdf, 'fz_outline_visit'):
+        # swig
+        visited_items = []
+        def outline_callback(depth, uri, is_open, title):
+            log(f'{" "*depth*4}uri={uri} is_open={is_open} title={title}')
+            visited_items.append((depth, uri, is_open, title))
+        mupdf.fz_outline_visit(document, outline_callback)
+        num_outline_items = len(visited_items)
+        outline_items = mupdf.fz_outline_iterator_walk(document)
+        assert outline_items == visited_items, \
+                f'outline_items={outline_items!r} visited_items={visited_items!r}'
+    else:
+        # cppyy
+        def olog(text):
+            if 0:
+                log(text)
+        num_outline_items = 0
+        depth = 0
+        it = mupdf.FzOutlineIterator(document)
+        while 1:
+            item = it.fz_outline_iterator_item()
+            olog(f'depth={depth} valid={item.valid()}')
+            if item.valid():
+                log(f'{" "*depth*4}uri={item.uri()} is_open={item.is_open()} title={item.title()}')
+                num_outline_items += 1
+            else:
+                olog(f'{" "*depth*4}<null>')
+            r = it.fz_outline_iterator_down()
+            olog(f'depth={depth} down => {r}')
+            if r >= 0:
+                depth += 1
+            if r < 0:
+                r = it.fz_outline_iterator_next()
+                olog(f'depth={depth} next => {r}')
+                assert r
+                if r:
+                    # No more items at current depth, so repeatedly go up until we
+                    # can go right.
+                    end = 0
+                    while 1:
+                        r = it.fz_outline_iterator_up()
+                        olog(f'depth={depth} up => {r}')
+                        if r < 0:
+                            # We are at EOF. Need to break out of top-level loop.
+                            end = 1
+                            break
+                        depth -= 1
+                        r = it.fz_outline_iterator_next()
+                        olog(f'depth={depth} next => {r}')
+                        if r == 0:
+                            # There are items at this level.
+                            break
+                    if end:
                         break
-                if end:
-                    break
     log(f'num_outline_items={num_outline_items}')
 
     # Check iteration over StextPage.
@@ -340,17 +417,14 @@ def test(path):
         log(f'no page_num={page_num}')
     else:
         device_stext = mupdf.FzDevice(stext_page, stext_options)
-        matrix = mupdf.FzMatrix()
-        page = mupdf.FzPage(document, 0)
+        matrix = g_matrix_identity
         cookie = mupdf.FzCookie()
         page.fz_run_page(device_stext, matrix, cookie)
         log(f'    stext_page is:')
         for block in stext_page:
             log(f'        block:')
             for line in block:
-                line_text = ''
-                for char in line:
-                    line_text += chr(char.m_internal.c)
+                line_text = ''.join(chr(char.m_internal.c) for char in line)
                 log(f'            {line_text}')
 
         device_stext.fz_close_device()
@@ -360,9 +434,9 @@ def test(path):
     document2 = mupdf.FzDocument(document)
     del document
     page = mupdf.FzPage(document2, 0)
-    scale = mupdf.FzMatrix()
+    scale = g_matrix_identity
     pixmap = mupdf.FzPixmap(page, scale, colorspace, 0)
-    pixmap.fz_save_pixmap_as_png('mupdf_test-out3.png')
+    pixmap.fz_save_pixmap_as_png(f'mupdf_test-out4-{g_test_n}.png')
 
     stdout = mupdf.FzOutput(mupdf.FzOutput.Fixed_STDOUT)
     log(f'{type(stdout)} {stdout.m_internal.state}')
@@ -370,9 +444,21 @@ def test(path):
     mediabox = page.fz_bound_page()
     out = mupdf.FzDocumentWriter(filename, 'png', '', mupdf.FzDocumentWriter.FormatPathType_DOCUMENT)
     dev = out.fz_begin_page(mediabox)
-    page.fz_run_page(dev, mupdf.FzMatrix(mupdf.fz_identity), mupdf.FzCookie())
+    page.fz_run_page(dev, g_matrix_identity, mupdf.FzCookie())
     out.fz_end_page()
 
+    # Check fz_install_constant_replacement_font() makes fz_load_system_font()
+    # return the replacement font, then remove it again.
+    #
+    if hasattr(mupdf, 'fz_install_constant_replacement_font'):
+        # swig
+        replacement_font = mupdf.fz_new_base14_font('Times-Roman')
+        mupdf.fz_install_constant_replacement_font(replacement_font)
+        font = mupdf.fz_load_system_font('qwerty', 0, 0, 0)
+        log(f'fz_load_system_font() returned font name={mupdf.fz_font_name(font)!r}')
+        assert font.m_internal_value() == replacement_font.m_internal_value()
+        mupdf.fz_install_constant_replacement_font(mupdf.FzFont())
+
     # Check out-params are converted into python return value.
     bitmap = mupdf.FzBitmap(10, 20, 8, 72, 72)
     bitmap_details = bitmap.fz_bitmap_details()
@@ -382,6 +468,20 @@ def test(path):
     log(f'finished test of %s' % path)
 
 
+def test_path(path, n):
+    '''
+    Runs test() on <path> with output filenames numbered <n>, for use in a
+    worker process where g_test_n is not shared with other processes.
+    '''
+    global g_test_n
+    g_test_n = n - 1
+    log_prefix_set(f'{os.path.relpath(path, g_mupdf_root)}: ')
+    try:
+        test(path)
+    finally:
+        log_prefix_set('')
+
+
 if __name__ == '__main__':
 
     paths = sys.argv[1:]
@@ -391,12 +491,13 @@ if __name__ == '__main__':
                 ]
     # Run test() on all the .pdf files in the mupdf repository.
     #
-    for path in paths:
-
-        log_prefix_set(f'{os.path.relpath(path, g_mupdf_root)}: ')
-        try:
-            test(path)
-        finally:
-            log_prefix_set('')
+    # Each path is independent so if there is more than one we use a separate
+    # process for each, up to the number of cpus.
+    #
+    if len(paths) == 1:
+        test_path(paths[0], 1)
+    else:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            list(executor.map(test_path, paths, range(1, len(paths) + 1)))
 
     log(f'finished')
@@ -2368,11 +2368,15 @@ def main2():
                     command = f'{command_prefix} {script_py}'
                     with open( f'{build_dirs.dir_mupdf}/platform/python/mupdf_test.py.out.txt', 'w') as f:
                         jlib.system( command, env_extra=env_extra, out='log', verbose=1)
-                        # Repeat with pdf_reference17.pdf if it exists.
+                        # Repeat with zlib.3.pdf and pdf_reference17.pdf if
+                        # the latter exists. Passing more than one path makes
+                        # mupdfwrap_test.py test them in parallel worker
+                        # processes.
                         path = os.path.relpath( f'{build_dirs.dir_mupdf}/../pdf_reference17.pdf')
                         if os.path.exists(path):
-                            jlib.log('Running mupdfwrap_test.py on {path}')
-                            command += f' {path}'
+                            zlib_pdf = os.path.relpath(f'{build_dirs.dir_mupdf}/thirdparty/zlib/zlib.3.pdf')
+                            jlib.log(f'Running mupdfwrap_test.py on {zlib_pdf} and {path}')
+                            command += f' {zlib_pdf} {path}'
                             jlib.system( command, env_extra=env_extra, out='log', verbose=1)
 
                     # Run mutool.py.
@@ -82,6 +82,7 @@ def build_swig(
     # Create a .i file for SWIG.
     #
     common = f'''
+            #include <mutex>
             #include <stdexcept>
 
             #include "mupdf/functions.h"
@@ -285,6 +286,280 @@ def build_swig(
                         }}
                     }}
                 }}
+
+                /* Walks the outline of <document> depth-first in C++, returning
+                a Python list of (depth, uri, is_open, title) tuples. This
+                avoids several SWIG calls per outline item from Python. */
+                PyObject* {rename.ll_fn('fz_outline_iterator_walk')}(fz_document* document)
+                {{
+                    PyObject* ret = PyList_New(0);
+                    if (!ret) return NULL;
+                    fz_outline_iterator* it;
+                    try
+                    {{
+                        it = {rename.namespace_ll_fn('fz_new_outline_iterator')}(document);
+                    }}
+                    catch (std::exception&)
+                    {{
+                        Py_DECREF(ret);
+                        throw;
+                    }}
+                    /* Document types without outline support give no iterator. */
+                    if (!it) return ret;
+                    int depth = 0;
+                    try
+                    {{
+                        for(;;)
+                        {{
+                            fz_outline_item* item = {rename.namespace_ll_fn('fz_outline_iterator_item')}(it);
+                            if (item)
+                            {{
+                                PyObject* t = Py_BuildValue("(isis)", depth, item->uri, item->is_open, item->title);
+                                int e = (t) ? PyList_Append(ret, t) : -1;
+                                Py_XDECREF(t);
+                                if (e)
+                                {{
+                                    {rename.namespace_ll_fn('fz_drop_outline_iterator')}(it);
+                                    Py_DECREF(ret);
+                                    return NULL;
+                                }}
+                            }}
+                            int r = {rename.namespace_ll_fn('fz_outline_iterator_down')}(it);
+                            if (r == 0)
+                            {{
+                                depth += 1;
+                                continue;
+                            }}
+                            if (r > 0)
+                            {{
+                                /* Undo move to empty position below item. */
+                                {rename.namespace_ll_fn('fz_outline_iterator_up')}(it);
+                            }}
+                            /* Go right, or up until we can go right. */
+                            while ({rename.namespace_ll_fn('fz_outline_iterator_next')}(it) != 0)
+                            {{
+                                if ({rename.namespace_ll_fn('fz_outline_iterator_up')}(it) < 0)
+                                {{
+                                    {rename.namespace_ll_fn('fz_drop_outline_iterator')}(it);
+                                    return ret;
+                                }}
+                                depth -= 1;
+                            }}
+                        }}
+                    }}
+                    catch (std::exception&)
+                    {{
+                        {rename.namespace_ll_fn('fz_drop_outline_iterator')}(it);
+                        Py_DECREF(ret);
+                        throw;
+                    }}
+                }}
+
+                /* Like fz_save_pixmap_as_png() but releases the Python GIL while
+                saving, so that other Python threads can run during the
+                encoding. Must not be used if a Python diagnostic callback has
+                been set with fz_set_warning_callback() or
+                fz_set_error_callback(), because these would then be called
+                without the GIL; the Python wrapper checks for this. */
+                void {rename.ll_fn('fz_save_pixmap_as_png_nogil')}(fz_pixmap* pixmap, const char* filename)
+                {{
+                    PyThreadState* thread_state = PyEval_SaveThread();
+                    try
+                    {{
+                        {rename.namespace_ll_fn('fz_save_pixmap_as_png')}(pixmap, filename);
+                    }}
+                    catch (std::exception&)
+                    {{
+                        PyEval_RestoreThread(thread_state);
+                        throw;
+                    }}
+                    PyEval_RestoreThread(thread_state);
+                }}
+
+                /* Saves <pixmap> as both .png and .pnm in a single pass over
+                its samples, passing each band of rows to both band writers
+                while the rows are in cache. The PNM writer throws for pixmaps
+                with alpha, spot colors or colorspaces such as CMYK, so this
+                only works with gray or RGB pixmaps without alpha.
+
+                If <release_gil> is true we release the Python GIL while
+                saving, which has the same restriction on Python diagnostic
+                callbacks as {rename.ll_fn('fz_save_pixmap_as_png_nogil')}(). */
+                void {rename.ll_fn('fz_save_pixmap_as_png_and_pnm')}(fz_pixmap* pixmap, const char* png_filename, const char* pnm_filename, int release_gil)
+                {{
+                    PyThreadState* thread_state = (release_gil) ? PyEval_SaveThread() : NULL;
+                    fz_output* png_out = NULL;
+                    fz_output* pnm_out = NULL;
+                    fz_band_writer* png_writer = NULL;
+                    fz_band_writer* pnm_writer = NULL;
+                    try
+                    {{
+                        png_out = {rename.namespace_ll_fn('fz_new_output_with_path')}(png_filename, 0 /*append*/);
+                        pnm_out = {rename.namespace_ll_fn('fz_new_output_with_path')}(pnm_filename, 0 /*append*/);
+                        png_writer = {rename.namespace_ll_fn('fz_new_png_band_writer')}(png_out);
+                        pnm_writer = {rename.namespace_ll_fn('fz_new_pnm_band_writer')}(pnm_out);
+                        for (fz_band_writer* writer: {{png_writer, pnm_writer}})
+                        {{
+                            {rename.namespace_ll_fn('fz_write_header')}(
+                                    writer,
+                                    pixmap->w,
+                                    pixmap->h,
+                                    pixmap->n,
+                                    pixmap->alpha,
+                                    pixmap->xres,
+                                    pixmap->yres,
+                                    0 /*pagenum*/,
+                                    pixmap->colorspace,
+                                    pixmap->seps
+                                    );
+                        }}
+                        /* fz_write_band() writes the trailer after the last
+                        band, so we always make at least one call, even if
+                        pixmap->h is zero. */
+                        const int band_height = 16;
+                        int y = 0;
+                        do
+                        {{
+                            const unsigned char* samples = pixmap->samples + (size_t) y * pixmap->stride;
+                            {rename.namespace_ll_fn('fz_write_band')}(png_writer, (int) pixmap->stride, band_height, samples);
+                            {rename.namespace_ll_fn('fz_write_band')}(pnm_writer, (int) pixmap->stride, band_height, samples);
+                            y += band_height;
+                        }}
+                        while (y < pixmap->h);
+                        {rename.namespace_ll_fn('fz_close_band_writer')}(png_writer);
+                        {rename.namespace_ll_fn('fz_close_band_writer')}(pnm_writer);
+                        {rename.namespace_ll_fn('fz_close_output')}(png_out);
+                        {rename.namespace_ll_fn('fz_close_output')}(pnm_out);
+                    }}
+                    catch (std::exception&)
+                    {{
+                        {rename.namespace_ll_fn('fz_drop_band_writer')}(png_writer);
+                        {rename.namespace_ll_fn('fz_drop_band_writer')}(pnm_writer);
+                        {rename.namespace_ll_fn('fz_drop_output')}(png_out);
+                        {rename.namespace_ll_fn('fz_drop_output')}(pnm_out);
+                        if (thread_state) PyEval_RestoreThread(thread_state);
+                        throw;
+                    }}
+                    {rename.namespace_ll_fn('fz_drop_band_writer')}(png_writer);
+                    {rename.namespace_ll_fn('fz_drop_band_writer')}(pnm_writer);
+                    {rename.namespace_ll_fn('fz_drop_output')}(png_out);
+                    {rename.namespace_ll_fn('fz_drop_output')}(pnm_out);
+                    if (thread_state) PyEval_RestoreThread(thread_state);
+                }}
+
+                /* Searches <page> for <needle>, returning a Python bytes that
+                contains up to <hit_max> fz_quads, each as eight consecutive
+                floats ul.x, ul.y, ur.x, ... lr.y. A hit that spans more than
+                one line gives more than one quad, so the number of quads can
+                be larger than the number of hits. This can be
+                converted in one go, for example with `array.array('f', ret)`
+                or `numpy.frombuffer(ret, numpy.float32).reshape(-1, 4, 2)`. */
+                PyObject* {rename.ll_fn('fz_search_page_quads')}(fz_page* page, const char* needle, int hit_max)
+                {{
+                    if (hit_max <= 0) return PyBytes_FromStringAndSize(NULL, 0);
+                    std::vector<fz_quad> quads(hit_max);
+                    int n = {rename.namespace_ll_fn('fz_search_page')}(page, needle, NULL /*hit_mark*/, &quads[0], hit_max);
+                    return PyBytes_FromStringAndSize((const char*) &quads[0], (Py_ssize_t) (n * sizeof(fz_quad)));
+                }}
+
+                /* Calls Python callable <callback>(depth, uri, is_open, title)
+                for each item in the outline of <document>, in depth-first
+                order. Stops and raises if <callback> raises. Uses an explicit
+                stack instead of recursion, so deeply nested outlines cannot
+                overflow the C stack. */
+                PyObject* {rename.ll_fn('fz_outline_visit')}(fz_document* document, PyObject* callback)
+                {{
+                    fz_outline* outline = {rename.namespace_ll_fn('fz_load_outline')}(document);
+                    int e = 0;
+                    try
+                    {{
+                        /* Items still to be visited, with their depths. */
+                        std::vector<std::pair<fz_outline*, int>> stack;
+                        if (outline) stack.push_back(std::make_pair(outline, 0));
+                        while (!stack.empty())
+                        {{
+                            fz_outline* item = stack.back().first;
+                            int depth = stack.back().second;
+                            stack.pop_back();
+                            PyObject* r = PyObject_CallFunction(callback, "isis", depth, item->uri, item->is_open, item->title);
+                            if (!r)
+                            {{
+                                e = -1;
+                                break;
+                            }}
+                            Py_DECREF(r);
+                            /* Push next before down so that we visit down first. */
+                            if (item->next) stack.push_back(std::make_pair(item->next, depth));
+                            if (item->down) stack.push_back(std::make_pair(item->down, depth + 1));
+                        }}
+                    }}
+                    catch (std::exception&)
+                    {{
+                        {rename.namespace_ll_fn('fz_drop_outline')}(outline);
+                        throw;
+                    }}
+                    {rename.namespace_ll_fn('fz_drop_outline')}(outline);
+                    if (e) return NULL;
+                    Py_RETURN_NONE;
+                }}
+
+                /* Looks up each key in Python sequence <keys> with
+                fz_lookup_metadata(), returning a Python dict that maps each key
+                to a str, or to None if the key is not found. */
+                PyObject* {rename.ll_fn('fz_lookup_metadata_many')}(fz_document* document, PyObject* keys)
+                {{
+                    PyObject* keys_fast = PySequence_Fast(keys, "keys must be a sequence");
+                    if (!keys_fast) return NULL;
+                    PyObject* ret = PyDict_New();
+                    if (!ret)
+                    {{
+                        Py_DECREF(keys_fast);
+                        return NULL;
+                    }}
+                    try
+                    {{
+                        Py_ssize_t n = PySequence_Fast_GET_SIZE(keys_fast);
+                        for (Py_ssize_t i=0; i<n; ++i)
+                        {{
+                            PyObject* key = PySequence_Fast_GET_ITEM(keys_fast, i);
+                            const char* key_s = PyUnicode_AsUTF8(key);
+                            if (!key_s)
+                            {{
+                                Py_DECREF(ret);
+                                Py_DECREF(keys_fast);
+                                return NULL;
+                            }}
+                            int e;
+                            std::string value = {rename.namespace_ll_fn('fz_lookup_metadata')}(document, key_s, &e);
+                            PyObject* v;
+                            if (e < 0)
+                            {{
+                                v = Py_None;
+                                Py_INCREF(v);
+                            }}
+                            else
+                            {{
+                                v = PyUnicode_FromString(value.c_str());
+                            }}
+                            int e2 = (v) ? PyDict_SetItem(ret, key, v) : -1;
+                            Py_XDECREF(v);
+                            if (e2)
+                            {{
+                                Py_DECREF(ret);
+                                Py_DECREF(keys_fast);
+                                return NULL;
+                            }}
+                        }}
+                    }}
+                    catch (std::exception&)
+                    {{
+                        Py_DECREF(ret);
+                        Py_DECREF(keys_fast);
+                        throw;
+                    }}
+                    Py_DECREF(keys_fast);
+                    return ret;
+                }}
                 ''')
 
     common += textwrap.dedent(f'''
@@ -317,6 +592,53 @@ def build_swig(
                 return {rename.namespace_class('fz_location')}( {rename.ll_fn('fz_lookup_bookmark2')}(doc.m_internal, mark));
             }}
 
+            /* Font returned by the callback installed by
+            {rename.fn('fz_install_constant_replacement_font')}(), protected by
+            s_constant_replacement_font_mutex because the callback can be
+            called from any thread's context. */
+            static fz_font* s_constant_replacement_font = NULL;
+            static std::mutex s_constant_replacement_font_mutex;
+
+            static fz_font* constant_replacement_font_fn(fz_context* ctx, const char* name, int bold, int italic, int needs_exact_metrics)
+            {{
+                std::lock_guard<std::mutex> lock(s_constant_replacement_font_mutex);
+                return fz_keep_font(ctx, s_constant_replacement_font);
+            }}
+
+            /* Installs a fz_load_system_font() callback that always returns
+            <font>, without calling back into Python or C#. The CJK and
+            fallback callbacks are set to NULL, because MuPDF caches the
+            fonts that they return for the lifetime of the font context.
+
+            If <font> is empty, removes all three load_system_font
+            callbacks, including any that were installed by other code. */
+            void {rename.fn('fz_install_constant_replacement_font')}(const {rename.namespace_class('fz_font')}& font)
+            {{
+                /* Keep the new font before dropping the old one in case they
+                are the same, and remove the callback before dropping the
+                font that it returns. */
+                fz_font* new_font = {rename.namespace_ll_fn('fz_keep_font')}(font.m_internal);
+                fz_font* old_font;
+                if (!new_font)
+                {{
+                    {rename.namespace_ll_fn('fz_install_load_system_font_funcs')}(NULL, NULL, NULL);
+                }}
+                {{
+                    std::lock_guard<std::mutex> lock(s_constant_replacement_font_mutex);
+                    old_font = s_constant_replacement_font;
+                    s_constant_replacement_font = new_font;
+                }}
+                if (new_font)
+                {{
+                    {rename.namespace_ll_fn('fz_install_load_system_font_funcs')}(
+                            constant_replacement_font_fn,
+                            NULL /*f_cjk*/,
+                            NULL /*f_fallback*/
+                            );
+                }}
+                {rename.namespace_ll_fn('fz_drop_font')}(old_font);
+            }}
+
             struct {rename.fn('fz_convert_color2_v')}
             {{
                 float v0;
@@ -720,6 +1042,11 @@ def build_swig(
             // it is #define-d to asprintf.
             %ignore {rename.ll_fn('Memento_asprintf')};
 
+            // Internals of {rename.fn('fz_install_constant_replacement_font')}().
+            %ignore s_constant_replacement_font;
+            %ignore s_constant_replacement_font_mutex;
+            %ignore constant_replacement_font_fn;
+
             // Might prefer to #include mupdf/exceptions.h and make the
             // %exception block below handle all the different exception types,
             // but swig-3 cannot parse 'throw()' in mupdf/exceptions.h.
@@ -1220,6 +1547,81 @@ def build_swig(
                     return ret
                 {rename.class_('fz_pixmap')}.{rename.method('fz_pixmap', 'fz_pixmap_samples2')} = {rename.fn('fz_pixmap_samples2')}
 
+                # Bulk outline iteration.
+                def {rename.fn('fz_outline_iterator_walk')}( document):
+                    """
+                    Returns list of `(depth, uri, is_open, title)` tuples for
+                    the outline of a `fz_document`, in depth-first order.
+                    """
+                    assert isinstance( document, {rename.class_('fz_document')})
+                    return {rename.ll_fn('fz_outline_iterator_walk')}( document.m_internal)
+                {rename.class_('fz_document')}.{rename.method('fz_document', 'fz_outline_iterator_walk')} = {rename.fn('fz_outline_iterator_walk')}
+
+                # Saving png without holding the GIL.
+                def {rename.fn('fz_save_pixmap_as_png_nogil')}( pixmap, filename):
+                    """
+                    Like `fz_save_pixmap_as_png()` but allows other Python
+                    threads to run while saving.
+
+                    If a Python error or warning callback has been set with
+                    `fz_set_error_callback()` or `fz_set_warning_callback()`,
+                    we keep the GIL and call `fz_save_pixmap_as_png()`,
+                    because MuPDF may call the callback while saving.
+                    """
+                    assert isinstance( pixmap, {rename.class_('fz_pixmap')})
+                    if set_error_callback_s or set_warning_callback_s:
+                        return {rename.ll_fn('fz_save_pixmap_as_png')}( pixmap.m_internal, filename)
+                    return {rename.ll_fn('fz_save_pixmap_as_png_nogil')}( pixmap.m_internal, filename)
+                {rename.class_('fz_pixmap')}.{rename.method('fz_pixmap', 'fz_save_pixmap_as_png_nogil')} = {rename.fn('fz_save_pixmap_as_png_nogil')}
+
+                # Saving png and pnm in a single pass.
+                def {rename.fn('fz_save_pixmap_as_png_and_pnm')}( pixmap, png_filename, pnm_filename):
+                    """
+                    Saves a `fz_pixmap` as both .png and .pnm, reading its
+                    samples only once. Only works with gray or RGB pixmaps
+                    without alpha; the PNM writer raises an exception for
+                    alpha, spot colors or other colorspaces such as CMYK.
+
+                    Allows other Python threads to run while saving, unless a
+                    Python error or warning callback has been set with
+                    `fz_set_error_callback()` or `fz_set_warning_callback()`.
+                    """
+                    assert isinstance( pixmap, {rename.class_('fz_pixmap')})
+                    release_gil = not (set_error_callback_s or set_warning_callback_s)
+                    return {rename.ll_fn('fz_save_pixmap_as_png_and_pnm')}( pixmap.m_internal, png_filename, pnm_filename, release_gil)
+                {rename.class_('fz_pixmap')}.{rename.method('fz_pixmap', 'fz_save_pixmap_as_png_and_pnm')} = {rename.fn('fz_save_pixmap_as_png_and_pnm')}
+
+                # Text search returning all quads in a single bytes.
+                def {rename.fn('fz_search_page_quads')}( page, needle, hit_max):
+                    """
+                    Returns a Python `bytes` containing eight floats for each
+                    quad found when searching a `fz_page` for `needle`.
+                    """
+                    assert isinstance( page, {rename.class_('fz_page')})
+                    return {rename.ll_fn('fz_search_page_quads')}( page.m_internal, needle, hit_max)
+                {rename.class_('fz_page')}.{rename.method('fz_page', 'fz_search_page_quads')} = {rename.fn('fz_search_page_quads')}
+
+                # Outline iteration with a callback.
+                def {rename.fn('fz_outline_visit')}( document, callback):
+                    """
+                    Calls `callback(depth, uri, is_open, title)` for each item
+                    in the outline of a `fz_document`, in depth-first order.
+                    """
+                    assert isinstance( document, {rename.class_('fz_document')})
+                    return {rename.ll_fn('fz_outline_visit')}( document.m_internal, callback)
+                {rename.class_('fz_document')}.{rename.method('fz_document', 'fz_outline_visit')} = {rename.fn('fz_outline_visit')}
+
+                # Bulk metadata lookup.
+                def {rename.fn('fz_lookup_metadata_many')}( document, keys):
+                    """
+                    Returns dict mapping each item in `keys` to the
+                    corresponding metadata string of a `fz_document`, or to
+                    None if not found.
+                    """
+                    assert isinstance( document, {rename.class_('fz_document')})
+                    return {rename.ll_fn('fz_lookup_metadata_many')}( document.m_internal, keys)
+                {rename.class_('fz_document')}.{rename.method('fz_document', 'fz_lookup_metadata_many')} = {rename.fn('fz_lookup_metadata_many')}
+
                 # Avoid potential unsafe use of variadic args by forcing a
                 # single arg and escaping all '%' characters. (Passing ('%s',
                 # text) does not work - results in "(null)" being output.)